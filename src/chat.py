@@ -4,25 +4,84 @@ Ponto de entrada para a interface de chat interativo com o usuário.
 Este script inicia um loop infinito que:
 1. Solicita uma pergunta ao usuário via linha de comando.
 2. Verifica se o usuário deseja sair da aplicação.
-3. Chama a função `search_prompt` do módulo `search` para obter uma resposta.
-4. Imprime a resposta gerada no console.
+3. Chama a função assíncrona `asearch_prompt` do módulo `search` para obter uma resposta.
+4. Imprime a resposta no console à medida que ela é gerada.
 
 Para executar, use: `python src/chat.py`
 """
-from search import search_prompt
+from pathlib import Path
+import asyncio
+import atexit
+import sys
 
-# Inicia o loop principal da aplicação de chat.
-while True:
-    # Solicita a entrada do usuário e armazena na variável 'query'.
-    query = input("\nFaça sua pergunta (ou 'sair' para encerrar): ")
+from config import settings
+from search import asearch_prompt, get_engine
 
-    # Verifica se a entrada do usuário é um comando para sair do loop.
-    if query.lower() in ("sair", "exit", "quit"):
-        print("Encerrando o chat. Até logo!")
-        break
+# Arquivo com o histórico de perguntas, mantido na raiz do projeto
+HISTORY_PATH = Path(__file__).parent.parent / ".chat_history"
 
-    # Chama a função de busca e geração de resposta com a pergunta do usuário.
-    result = search_prompt(query)
+# Habilita a edição de linha e o histórico de perguntas entre execuções (setas
+# para cima/baixo), facilitando repetir perguntas, que são respondidas pelo cache.
+# O módulo `readline` não está disponível no Windows.
+try:
+    import readline
+except ImportError:
+    readline = None
 
-    # Imprime o resultado retornado pela função.
-    print(result)
\ No newline at end of file
+if readline is not None:
+    try:
+        readline.read_history_file(HISTORY_PATH)
+    except FileNotFoundError:
+        pass
+    atexit.register(readline.write_history_file, HISTORY_PATH)
+
+
+def write_chunk(chunk):
+    """Escreve um trecho da resposta no console assim que ele é recebido."""
+    sys.stdout.write(chunk)
+    sys.stdout.flush()
+
+
+async def main():
+    """Executa o loop principal da aplicação de chat."""
+    # Valida as variáveis de ambiente antes da primeira pergunta, para que uma
+    # configuração incompleta interrompa o chat imediatamente.
+    settings()
+
+    try:
+        while True:
+            # Solicita a entrada do usuário e armazena na variável 'query'. A leitura
+            # bloqueia o event loop, o que não é um problema aqui: enquanto o chat
+            # aguarda a pergunta não há nenhuma outra tarefa em execução.
+            try:
+                query = input("\nFaça sua pergunta (ou 'sair' para encerrar): ")
+            except (EOFError, KeyboardInterrupt):
+                # Ctrl+D ou Ctrl+C no prompt encerram o chat normalmente.
+                query = "sair"
+                print()
+
+            # Verifica se a entrada do usuário é um comando para sair do loop.
+            if query.lower() in ("sair", "exit", "quit"):
+                print("Encerrando o chat. Até logo!")
+                break
+
+            # Chama a função de busca e geração de resposta com a pergunta do usuário,
+            # imprimindo cada trecho da resposta assim que ele é gerado.
+            await asearch_prompt(query, on_token=write_chunk)
+
+            # Encerra a linha da resposta.
+            write_chunk("\n")
+    finally:
+        # Fecha as conexões com o banco de dados antes de encerrar o event loop,
+        # inclusive quando o chat é interrompido durante uma resposta. O engine
+        # só é descartado se chegou a ser criado por alguma pergunta.
+        if get_engine.cache_info().currsize:
+            await get_engine().dispose()
+
+
+# O driver assíncrono do psycopg não funciona com o event loop padrão do Windows.
+if sys.platform == "win32":
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+# Inicia a aplicação de chat.
+asyncio.run(main())
@@ -0,0 +1,65 @@
+"""
+Configuração compartilhada pelos scripts de ingestão e de chat.
+
+As variáveis de ambiente (e o arquivo .env, quando existir) são lidas e
+validadas uma única vez, na primeira chamada de `settings()`. As chamadas
+seguintes reaproveitam o mesmo objeto, sem reler o ambiente.
+"""
+from functools import lru_cache
+from typing import Literal, Optional
+
+from dotenv import load_dotenv
+from pydantic_settings import BaseSettings
+
+
+class Settings(BaseSettings):
+    """
+    Variáveis de ambiente utilizadas pela aplicação.
+
+    Cada campo corresponde à variável de ambiente de mesmo nome em letras
+    maiúsculas. Campos sem valor padrão são obrigatórios e a ausência de
+    qualquer um deles interrompe a execução com um erro de validação.
+    """
+
+    # Chave da API da OpenAI
+    openai_api_key: str
+    # URL de conexão com o PostgreSQL e nome da coleção de documentos
+    pgvector_url: str
+    pgvector_collection: str
+
+    # Modelos da OpenAI utilizados para respostas e embeddings
+    openai_model: str
+    embedding_model: str = "text-embedding-3-small"
+    embedding_dimensions: int = 1536
+
+    # Biblioteca usada para extrair o texto do PDF. O PyMuPDF é mais rápido, mas
+    # é distribuído sob a licença AGPL-3.0 e precisa ser instalado à parte.
+    pdf_loader: Literal["pypdf", "pymupdf"] = "pypdf"
+
+    # Parâmetros de busca
+    hnsw_ef_search: int = 100
+    binary_candidates: int = 100
+
+    # Cache de respostas do chat
+    semantic_cache_threshold: float = 0.95
+    query_cache_max_entries: int = 1000
+    query_cache_ttl_hours: float = 24
+
+    # Filtro de relevância dos trechos recuperados
+    score_threshold: Optional[float] = None
+
+    # Reordenação local dos trechos recuperados (desabilitada quando rerank_topk não é definido)
+    rerank_topk: Optional[int] = None
+    rerank_model: str = "BAAI/bge-reranker-base"
+
+
+@lru_cache
+def settings() -> Settings:
+    """
+    Carrega e valida a configuração da aplicação.
+
+    O arquivo .env é carregado no ambiente do processo para que as bibliotecas
+    da OpenAI também encontrem a `OPENAI_API_KEY`.
+    """
+    load_dotenv()
+    return Settings()
@@ -2,39 +2,191 @@
 Script para ingestão de documentos PDF em um banco de dados vetorial PGVector.
 
 Este script realiza o seguinte processo de pipeline para RAG (Retrieval-Augmented Generation):
-1. Carrega as variáveis de ambiente necessárias (chaves de API, URLs de banco de dados).
+1. Carrega e valida as variáveis de ambiente necessárias (chaves de API, URLs de banco de dados).
 2. Localiza e carrega um arquivo PDF especificado na raiz do projeto.
-3. Divide o documento em trechos (chunks) de texto menores.
-4. Limpa e enriquece os metadados de cada trecho.
-5. Gera embeddings para cada trecho usando a API da OpenAI.
-6. Insere os trechos e seus embeddings correspondentes em uma coleção no PGVector,
-   apagando a coleção anterior para garantir dados atualizados.
+3. Divide o documento em trechos (chunks) de até 400 tokens.
+4. Limpa e enriquece os metadados de cada trecho e descarta trechos repetidos.
+5. Gera embeddings para os trechos novos usando a API da OpenAI, em lotes
+   concorrentes e reaproveitando os embeddings já armazenados no cache local.
+6. Insere na coleção do PGVector apenas os trechos novos, identificados pelo hash
+   do conteúdo, e remove os trechos que não existem mais no documento.
+7. Converte os embeddings para `halfvec`, adiciona sua quantização binária e cria
+   um índice HNSW sobre ela para acelerar as buscas de similaridade.
 
 Pré-requisitos:
 - Um arquivo .env na raiz do projeto com as variáveis de ambiente definidas.
 - O arquivo PDF a ser processado deve estar na raiz do projeto.
 """
 from pathlib import Path
-from langchain_community.document_loaders import PyPDFLoader
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
+from langchain_community.document_loaders import PyMuPDFLoader, PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from langchain_postgres import PGVector
 from langchain_core.documents import Document
+from sqlalchemy import create_engine, text
 
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+import asyncio
+import hashlib
 import os
-from dotenv import load_dotenv
-
-# Carrega as variáveis de ambiente do arquivo .env
-load_dotenv()
-# Valida se as variáveis de ambiente essenciais estão configuradas
-for k in ("OPENAI_API_KEY", "PGVECTOR_URL","PGVECTOR_COLLECTION"):
-    if not os.getenv(k):
-        raise RuntimeError(f"Environment variable {k} is not set")
+from config import settings
 
 # Define o caminho para o arquivo PDF, assumindo que ele está na raiz do projeto
 PDF_DIR = Path(__file__).parent.parent
 PDF_PATH = PDF_DIR / "document.pdf"
 
+# Diretório do cache local de embeddings, também na raiz do projeto
+EMBEDDING_CACHE_DIR = PDF_DIR / ".emb_cache"
+
+def split_shard(docs, model_name):
+    """
+    Divide uma parte dos documentos em trechos menores.
+
+    Executada nos processos de trabalho de `split_documents`. O splitter é
+    criado dentro do próprio processo, pois não é serializado de forma confiável.
+    O tamanho dos trechos é medido em tokens do tokenizador do modelo de
+    embeddings, o que gera trechos mais uniformes e um custo de prompt previsível.
+    """
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        model_name=model_name,
+        chunk_size=400,
+        chunk_overlap=40, add_start_index=False).split_documents(docs)
+
+def split_documents(docs, model_name):
+    """
+    Divide os documentos em trechos usando um processo por núcleo de CPU.
+
+    As páginas são distribuídas em blocos contíguos entre os processos e os
+    trechos resultantes são reunidos na ordem original do documento.
+    """
+    workers = min(os.cpu_count() or 1, len(docs))
+    if workers <= 1:
+        return split_shard(docs, model_name)
+
+    size = -(-len(docs) // workers)
+    shards = [docs[i:i + size] for i in range(0, len(docs), size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(chain.from_iterable(executor.map(split_shard, shards, repeat(model_name))))
+
+async def aembed_in_batches(embeddings, texts, batch_size=256, concurrency=8):
+    """
+    Gera os embeddings dos textos em lotes, com várias requisições simultâneas.
+
+    Cada lote corresponde a uma chamada à API de embeddings e o semáforo limita
+    quantas chamadas ficam em andamento ao mesmo tempo. A ordem dos vetores
+    retornados é a mesma dos textos recebidos.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embeddings.aembed_documents(batch)
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return [vector for batch in results for vector in batch]
+
+def fetch_collection_ids(engine, collection_name):
+    """
+    Retorna o conjunto de IDs dos documentos já armazenados na coleção.
+    """
+    with engine.connect() as conn:
+        return set(conn.execute(text(
+            "SELECT e.id FROM langchain_pg_embedding e "
+            "JOIN langchain_pg_collection c ON e.collection_id = c.uuid "
+            "WHERE c.name = :name"
+        ), {"name": collection_name}).scalars())
+
+def create_hnsw_index(engine):
+    """
+    Cria, caso ainda não existam, os índices HNSW sobre os embeddings.
+
+    Sem um índice ANN as buscas de similaridade fazem uma varredura sequencial
+    sobre todos os vetores da tabela. É criada a coluna `embedding_bits`, com a
+    quantização binária de cada embedding, e um índice por distância de Hamming
+    sobre ela, usado na primeira etapa da busca. A segunda etapa calcula a
+    distância exata apenas sobre os candidatos, sem índice, por isso a coluna
+    `halfvec` não é indexada. A operação é idempotente e pode ser executada ao
+    final de cada ingestão.
+    """
+    dimensions = settings().embedding_dimensions
+    with engine.begin() as conn:
+        # O PGVector cria a coluna como `vector` sem dimensão fixa. Ela é convertida
+        # para `halfvec` (FP16), que ocupa metade da memória e do I/O por vetor,
+        # com dimensão definida, exigida pelo HNSW. O tipo só é alterado quando
+        # ainda for diferente, e a coluna quantizada antiga é removida por
+        # depender do tipo.
+        column_type = conn.execute(text(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = 'langchain_pg_embedding'::regclass AND attname = 'embedding'"
+        )).scalar()
+        if column_type != f"halfvec({dimensions})":
+            conn.execute(text("ALTER TABLE langchain_pg_embedding DROP COLUMN IF EXISTS embedding_bits"))
+            # O cache de respostas guarda embeddings da dimensão anterior e é recriado.
+            conn.execute(text("DROP TABLE IF EXISTS langchain_query_cache"))
+            conn.execute(text(
+                "ALTER TABLE langchain_pg_embedding "
+                f"ALTER COLUMN embedding TYPE halfvec({dimensions}) "
+                f"USING embedding::halfvec({dimensions})"
+            ))
+
+        # Coluna gerada com a quantização binária do embedding (1 bit por dimensão),
+        # 16 vezes menor que o `halfvec`, mantida automaticamente pelo PostgreSQL.
+        conn.execute(text(
+            "ALTER TABLE langchain_pg_embedding ADD COLUMN IF NOT EXISTS "
+            f"embedding_bits bit({dimensions}) "
+            f"GENERATED ALWAYS AS (binary_quantize(embedding)::bit({dimensions})) STORED"
+        ))
+
+        # Memória e paralelismo extras deixam a construção do índice mais rápida.
+        conn.execute(text("SET LOCAL maintenance_work_mem = '2GB'"))
+        conn.execute(text("SET LOCAL max_parallel_maintenance_workers = 7"))
+        # Remove o índice sobre a coluna `halfvec` criado por versões anteriores deste
+        # script, que não é usado pela busca e só encarece as inserções.
+        conn.execute(text("DROP INDEX IF EXISTS idx_lc_emb_hnsw"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_lc_emb_bits_hnsw ON langchain_pg_embedding "
+            "USING hnsw (embedding_bits bit_hamming_ops) WITH (m = 16, ef_construction = 64)"
+        ))
+
+def create_query_cache_table(engine):
+    """
+    Cria, caso ainda não exista, a tabela do cache de respostas do chat.
+
+    O cache fica em uma tabela própria, e não em uma coleção do PGVector, para
+    que suas linhas não disputem com os trechos do documento os candidatos
+    retornados pelo índice HNSW da tabela de embeddings.
+    """
+    dimensions = settings().embedding_dimensions
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS langchain_query_cache ("
+            "collection VARCHAR NOT NULL, "
+            "id VARCHAR NOT NULL, "
+            "question TEXT NOT NULL, "
+            "answer TEXT NOT NULL, "
+            f"embedding halfvec({dimensions}) NOT NULL, "
+            "created_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+            "PRIMARY KEY (collection, id))"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_lc_query_cache_hnsw ON langchain_query_cache "
+            "USING hnsw (embedding halfvec_cosine_ops)"
+        ))
+
+def clear_query_cache(engine, collection_name):
+    """
+    Remove do cache as respostas baseadas na coleção informada.
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            text("DELETE FROM langchain_query_cache WHERE collection = :collection"),
+            {"collection": collection_name},
+        )
+
 def ingest_pdf():
     """
     Executa o processo de ingestão do PDF.
@@ -42,44 +194,102 @@ def ingest_pdf():
     Carrega o documento, o divide em trechos, gera embeddings e os armazena
     no banco de dados PGVector.
     """
+    # Carrega e valida as variáveis de ambiente antes de iniciar o processamento
+    config = settings()
+
     print("Realizando a leitura e split do arquivo.")
-    docs = PyPDFLoader(str(PDF_PATH)).load()
+    # O pypdf é o padrão; o PyMuPDF (AGPL-3.0) é usado apenas quando configurado
+    loader = PyMuPDFLoader if config.pdf_loader == "pymupdf" else PyPDFLoader
+    docs = loader(str(PDF_PATH)).load()
 
-    # Divide os documentos em trechos menores para facilitar a busca de similaridade
-    splits = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=150, add_start_index=False).split_documents(docs)
+    # Divide os documentos em trechos menores para facilitar a busca de similaridade,
+    # processando as páginas em paralelo
+    splits = split_documents(docs, config.embedding_model)
     if not splits:
         print("Nenhum documento para processar. Encerrando.")
         raise SystemExit(0)
 
     # Enriquece os documentos, removendo metadados vazios ou nulos que podem
-    # interferir no processo de embedding ou armazenamento.
-    enriched = [
-        Document(
+    # interferir no processo de embedding ou armazenamento. Trechos repetidos
+    # (cabeçalhos, rodapés, avisos) são descartados, mantendo a primeira ocorrência.
+    enriched = []
+    ids = []
+    seen = set()
+    for d in splits:
+        digest = hashlib.sha256(d.page_content.strip().encode()).hexdigest()
+        # O hash do conteúdo também é o ID do documento, o que mantém os IDs
+        # estáveis entre ingestões e garante a idempotência na inserção
+        doc_id = f"sha-{digest}"
+        if doc_id in seen:
+            continue
+        seen.add(doc_id)
+        ids.append(doc_id)
+        enriched.append(Document(
             page_content=d.page_content,
             metadata={k: v for k, v in d.metadata.items() if v not in ("", None)}
-        )
-        for d in splits
-    ]
+        ))
 
-    # Gera IDs únicos para cada documento para garantir a idempotência na inserção
-    ids = [f"doc-{i}" for i in range(len(enriched))]
-
-    print("Inserindo os dados no banco de dados.")
     # Inicializa o modelo de embeddings da OpenAI
-    embeddings = OpenAIEmbeddings(model=os.getenv("EMBEDDING_MODEL","text-embedding-3-small"))
-
-    # Conecta ao PGVector e insere os documentos e seus embeddings
-    PGVector.from_documents(
-        documents=enriched,
-        embedding=embeddings,
-        collection_name=os.getenv("PGVECTOR_COLLECTION"),
-        connection=os.getenv("PGVECTOR_URL"),
-        pre_delete_collection=True, # Garante que a coleção seja limpa antes da nova inserção
-        ids=ids,
+    # Envolve o modelo com um cache em disco, indexado pelo SHA-256 do texto, para
+    # que trechos já vetorizados em ingestões anteriores não voltem à API.
+    # O namespace pelo nome do modelo invalida o cache quando o modelo muda.
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        OpenAIEmbeddings(model=config.embedding_model),
+        LocalFileStore(str(EMBEDDING_CACHE_DIR)),
+        namespace=config.embedding_model,
+        key_encoder="sha256",
+    )
+
+    # Conecta ao PGVector sem apagar a coleção existente: como os IDs derivam do
+    # conteúdo, apenas os trechos novos ou alterados precisam ser inseridos.
+    engine = create_engine(config.pgvector_url)
+    collection_name = config.pgvector_collection
+    store = PGVector(
+        embeddings=embeddings,
+        collection_name=collection_name,
+        connection=engine,
+        pre_delete_collection=False,
     )
-    print("Dados inseridos no banco de dados.")
+
+    # Compara os IDs atuais com os já armazenados para saber o que inserir e
+    # o que remover por não existir mais no documento.
+    existing = fetch_collection_ids(engine, collection_name)
+    missing = [(doc_id, d) for doc_id, d in zip(ids, enriched) if doc_id not in existing]
+    stale = list(existing - seen)
+
+    if missing:
+        print(f"Gerando os embeddings de {len(missing)} trechos novos.")
+        # Gera os embeddings em lotes de 256 textos, com até 8 requisições simultâneas
+        texts = [d.page_content for _, d in missing]
+        vectors = asyncio.run(aembed_in_batches(embeddings, texts))
+
+        print("Inserindo os dados no banco de dados.")
+        store.add_embeddings(
+            texts=texts,
+            embeddings=vectors,
+            metadatas=[d.metadata for _, d in missing],
+            ids=[doc_id for doc_id, _ in missing],
+        )
+
+    if stale:
+        print(f"Removendo {len(stale)} trechos que não existem mais no documento.")
+        store.delete(ids=stale)
+
+    if missing or stale:
+        print("Dados atualizados no banco de dados.")
+    else:
+        print("Nenhuma alteração no documento desde a última ingestão.")
+
+    print("Criando os índices HNSW.")
+    create_hnsw_index(engine)
+    create_query_cache_table(engine)
+    print("Índices HNSW criados.")
+
+    if missing or stale:
+        # Limpa o cache de respostas do chat, que pode conter respostas baseadas
+        # na versão anterior do documento.
+        clear_query_cache(engine, collection_name)
+    engine.dispose()
 
 # Ponto de entrada do script: executa a função de ingestão quando o arquivo é chamado diretamente
 if __name__ == "__main__":
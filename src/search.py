@@ -6,17 +6,23 @@ Retrieval-Augmented Generation (RAG). Ele inicializa e configura todos os
 componentes necessários da biblioteca LangChain, como o modelo de embeddings,
 a conexão com o banco de dados vetorial (PGVector) e a pipeline de LLM.
 
-A função principal, `search_prompt`, recebe uma pergunta do usuário, busca
+A função principal, `asearch_prompt`, recebe uma pergunta do usuário, busca
 documentos relevantes no banco de dados e gera uma resposta contextualizada.
+Ela é assíncrona, de modo que as chamadas ao banco de dados e à API da OpenAI
+não bloqueiam o event loop e várias perguntas podem ser atendidas ao mesmo tempo.
 """
 from langchain.prompts import PromptTemplate
 from langchain_openai import OpenAIEmbeddings
-from langchain_postgres import PGVector
 from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.documents import Document
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
 
-from dotenv import load_dotenv
-import os
+from config import settings
+from functools import lru_cache
+import asyncio
+import hashlib
 
 # Template do prompt, projetado para ser robusto e garantir que o LLM
 # responda estritamente com base no contexto fornecido. Inclui regras claras
@@ -48,70 +54,303 @@ PERGUNTA DO USUÁRIO:
 RESPONDA A "PERGUNTA DO USUÁRIO"
 """
 
-# Carrega as variáveis de ambiente do arquivo .env.
-load_dotenv()
-# Valida se todas as variáveis de ambiente essenciais estão configuradas.
-# Isso garante que o script falhe rapidamente se a configuração estiver incompleta.
-for k in ("OPENAI_API_KEY", "PGVECTOR_URL","PGVECTOR_COLLECTION", "OPENAI_MODEL", "EMBEDDING_MODEL"):
-    if not os.getenv(k):
-        raise RuntimeError(f"Environment variable {k} is not set")
+# Busca pelos trechos mais próximos em duas etapas:
+# 1. Seleciona `:candidates` trechos pela distância de Hamming (`<~>`) entre as
+#    quantizações binárias, usando o índice HNSW sobre `embedding_bits`. Cada
+#    comparação lê 1 bit por dimensão em vez de 2 bytes.
+# 2. Reordena apenas esses candidatos pela distância de cosseno (`<=>`) exata
+#    sobre o `halfvec` e retorna os `:k` mais próximos.
+# O vetor da pergunta é convertido explicitamente para `halfvec`, o mesmo tipo
+# da coluna criada pelo script de ingestão.
+SIMILARITY_QUERY = text("""
+SELECT id, document, cmetadata,
+       embedding <=> CAST(:embedding AS halfvec) AS distance
+FROM (
+    SELECT e.id, e.document, e.cmetadata, e.embedding
+    FROM langchain_pg_embedding e
+    JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+    WHERE c.name = :collection
+    ORDER BY e.embedding_bits <~> binary_quantize(CAST(:embedding AS halfvec))
+    LIMIT :candidates
+) candidates
+ORDER BY distance
+LIMIT :k
+""")
+
+
+# Consultas do cache de respostas, armazenado na tabela `langchain_query_cache`
+# criada pelo script de ingestão. Entradas mais antigas que `:ttl_hours` são
+# ignoradas nas buscas e removidas a cada nova gravação, junto com as que
+# excedem o limite de `:max_entries` por coleção.
+CACHE_EXACT_QUERY = text("""
+SELECT answer FROM langchain_query_cache
+WHERE collection = :collection AND id = :id
+  AND created_at > now() - make_interval(secs => :ttl_hours * 3600)
+""")
+
+CACHE_SEMANTIC_QUERY = text("""
+SELECT answer, embedding <=> CAST(:embedding AS halfvec) AS distance
+FROM langchain_query_cache
+WHERE collection = :collection
+  AND created_at > now() - make_interval(secs => :ttl_hours * 3600)
+ORDER BY distance
+LIMIT 1
+""")
+
+CACHE_INSERT_QUERY = text("""
+INSERT INTO langchain_query_cache (collection, id, question, answer, embedding)
+VALUES (:collection, :id, :question, :answer, CAST(:embedding AS halfvec))
+ON CONFLICT (collection, id) DO UPDATE
+SET answer = EXCLUDED.answer, embedding = EXCLUDED.embedding, created_at = now()
+""")
+
+CACHE_PRUNE_QUERY = text("""
+DELETE FROM langchain_query_cache
+WHERE collection = :collection
+  AND (created_at <= now() - make_interval(secs => :ttl_hours * 3600)
+       OR id NOT IN (
+           SELECT id FROM langchain_query_cache
+           WHERE collection = :collection
+           ORDER BY created_at DESC
+           LIMIT :max_entries))
+""")
+
+
+async def aget_cached_answer(engine, key, embedding):
+    """
+    Procura no cache uma resposta para a pergunta.
+
+    Procura primeiro uma pergunta idêntica, pelo SHA-256 do texto (`key`), e
+    depois a pergunta mais parecida, cuja similaridade de cosseno precisa
+    atingir `SEMANTIC_CACHE_THRESHOLD`. A busca semântica só é feita quando o
+    embedding da pergunta é informado.
+
+    Returns:
+        str | None: A resposta armazenada, ou None se não houver no cache.
+    """
+    params = {"collection": settings().pgvector_collection, "ttl_hours": settings().query_cache_ttl_hours}
+    async with engine.connect() as conn:
+        if embedding is None:
+            return (await conn.execute(CACHE_EXACT_QUERY, {**params, "id": key})).scalar()
+
+        # A busca retorna a distância de cosseno, então a similaridade é `1 - distância`.
+        row = (await conn.execute(CACHE_SEMANTIC_QUERY, {**params, "embedding": str(list(embedding))})).first()
+    if row is not None and 1 - row.distance >= settings().semantic_cache_threshold:
+        return row.answer
+    return None
+
+
+async def astore_cached_answer(engine, key, question, embedding, answer):
+    """
+    Grava a resposta no cache e remove as entradas expiradas ou excedentes.
+    """
+    params = {"collection": settings().pgvector_collection, "ttl_hours": settings().query_cache_ttl_hours}
+    async with engine.begin() as conn:
+        await conn.execute(CACHE_INSERT_QUERY, {
+            "collection": params["collection"],
+            "id": key,
+            "question": question,
+            "answer": answer,
+            "embedding": str(list(embedding)),
+        })
+        await conn.execute(CACHE_PRUNE_QUERY, {**params, "max_entries": settings().query_cache_max_entries})
+
+
+async def asimilarity_search(engine, collection_name, embedding, k):
+    """
+    Busca na coleção os `k` trechos mais próximos do vetor informado.
+
+    Args:
+        engine (AsyncEngine): Engine assíncrono do banco de dados.
+        collection_name (str): Nome da coleção do PGVector a ser consultada.
+        embedding (list[float]): Embedding da pergunta.
+        k (int): Quantidade de trechos retornados.
+
+    Returns:
+        list[tuple[Document, float]]: Os trechos encontrados e suas distâncias de
+            cosseno, do mais próximo para o mais distante.
+    """
+    # O índice HNSW retorna no máximo `hnsw.ef_search` linhas, então o valor é
+    # elevado, apenas nesta transação, até a quantidade de candidatos pedida.
+    candidates = max(settings().binary_candidates, k)
+    async with engine.begin() as conn:
+        await conn.execute(
+            text("SELECT set_config('hnsw.ef_search', :ef_search, true)"),
+            {"ef_search": str(max(settings().hnsw_ef_search, candidates))},
+        )
+        result = await conn.execute(SIMILARITY_QUERY, {
+            "embedding": str(list(embedding)),
+            "collection": collection_name,
+            "candidates": candidates,
+            "k": k,
+        })
+        rows = result.all()
+    return [
+        (Document(id=row.id, page_content=row.document, metadata=row.cmetadata), row.distance)
+        for row in rows
+    ]
+
 
 # --- Inicialização dos Componentes LangChain ---
-# Estes objetos são criados uma única vez quando o módulo é importado,
-# o que otimiza o desempenho, evitando recriações a cada chamada de função.
+# Estes objetos são criados sob demanda, na primeira vez em que são usados, e
+# reaproveitados nas chamadas seguintes. Assim, importar este módulo não abre
+# conexões com o PostgreSQL nem cria clientes da OpenAI.
+
+@lru_cache
+def get_embeddings():
+    """
+    Retorna o modelo de embeddings da OpenAI, usado para vetorizar as perguntas
+    do usuário para a busca de similaridade.
+    """
+    return OpenAIEmbeddings(model=settings().embedding_model)
+
+
+@lru_cache
+def get_engine():
+    """
+    Retorna o engine assíncrono do banco de dados.
+
+    O `hnsw.ef_search` é definido em cada sessão. O valor controla o equilíbrio
+    entre recall e latência da busca no índice HNSW sem exigir alterações na
+    configuração global do PostgreSQL. A busca iterativa (pgvector 0.8+) faz o
+    índice continuar retornando candidatos quando o filtro por coleção descarta
+    os primeiros, evitando buscas com menos de `k` resultados quando há várias
+    coleções na mesma tabela. Versões anteriores ignoram a opção.
+    """
+    return create_async_engine(
+        settings().pgvector_url,
+        connect_args={"options": (
+            f"-c hnsw.ef_search={settings().hnsw_ef_search} "
+            "-c hnsw.iterative_scan=relaxed_order"
+        )},
+    )
+
+
+@lru_cache
+def get_pipeline():
+    """
+    Monta a pipeline de execução usando LangChain Expression Language (LCEL).
+
+    A pipeline define o fluxo: (template -> llm -> parser).
+    1. O `template` recebe o contexto e a pergunta.
+    2. O resultado é enviado para o `llm`, com temperatura 0 para obter respostas
+       mais determinísticas e factuais, e streaming para exibir a resposta à
+       medida que os tokens são gerados.
+    3. A resposta do `llm` é processada pelo `StrOutputParser` para retornar uma string.
+    """
+    template = PromptTemplate.from_template(PROMPT_TEMPLATE)
+    llm = ChatOpenAI(model=settings().openai_model, temperature=0, streaming=True)
+    return template | llm | StrOutputParser()
 
-# Inicializa o modelo de embeddings da OpenAI, que será usado para vetorizar
-# as perguntas do usuário para a busca de similaridade.
-embeddings = OpenAIEmbeddings(model=os.getenv("EMBEDDING_MODEL","text-embedding-3-small"))
 
-# Configura a conexão com o banco de dados vetorial PGVector.
-# Este objeto `store` será usado para realizar as buscas de similaridade.
-store = PGVector(
-    embeddings=embeddings,
-    collection_name=os.getenv("PGVECTOR_COLLECTION"),
-    connection=os.getenv("PGVECTOR_URL"),
-    use_jsonb=True,
-)
+@lru_cache
+def get_reranker():
+    """
+    Retorna o modelo cross-encoder local usado para reordenar os trechos recuperados.
+
+    O pacote `sentence-transformers` é importado apenas aqui, pois só é
+    necessário quando a reordenação está habilitada por `RERANK_TOPK`.
+    """
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(settings().rerank_model)
+
 
-# Cria um objeto PromptTemplate a partir da string de template definida anteriormente.
-template = PromptTemplate.from_template(PROMPT_TEMPLATE)
+def rerank(question, results, top_k):
+    """
+    Reordena os trechos recuperados pela relevância em relação à pergunta.
+
+    O cross-encoder avalia cada par (pergunta, trecho) em conjunto, o que é mais
+    preciso que a distância entre embeddings, e apenas os `top_k` trechos mais
+    relevantes são mantidos.
+    """
+    scores = get_reranker().predict([(question, doc.page_content) for doc, _ in results])
+    ranked = sorted(zip(scores, results), key=lambda pair: pair[0], reverse=True)
+    return [result for _, result in ranked[:top_k]]
 
-# Inicializa o modelo de linguagem (LLM) da OpenAI com temperatura 0 para
-# obter respostas mais determinísticas e factuais.
-llm = ChatOpenAI(model=os.getenv("OPENAI_MODEL"), temperature=0)
 
-# Monta a pipeline de execução usando LangChain Expression Language (LCEL).
-# A pipeline define o fluxo: (template -> llm -> parser).
-# 1. O `template` recebe o contexto e a pergunta.
-# 2. O resultado é enviado para o `llm`.
-# 3. A resposta do `llm` é processada pelo `StrOutputParser` para retornar uma string.
-pipeline = template | llm | StrOutputParser()
+def _emit(text, on_token):
+    """Repassa um trecho da resposta para `on_token`, quando informado, e o retorna."""
+    if on_token is not None:
+        on_token(text)
+    return text
 
 
-def search_prompt(question=None) :
+async def asearch_prompt(question=None, on_token=None) :
     """
     Executa a busca por similaridade e a geração da resposta via LLM.
 
     Esta função recebe uma pergunta, busca os 10 trechos de texto mais
     relevantes no banco de dados vetorial e os utiliza como contexto para
-    gerar uma resposta com o modelo de linguagem.
+    gerar uma resposta com o modelo de linguagem. Quando `RERANK_TOPK` está
+    definido, são buscados 30 trechos, reordenados por um cross-encoder local,
+    e apenas os `RERANK_TOPK` melhores são enviados ao modelo. Perguntas idênticas ou
+    semanticamente equivalentes a perguntas anteriores são respondidas
+    diretamente a partir do cache, sem consultar os documentos nem o LLM.
 
     Args:
         question (str, optional): A pergunta feita pelo usuário. Defaults to None.
+        on_token (callable, optional): Função chamada com cada trecho da resposta
+            assim que ele é gerado. Respostas vindas do cache são entregues em
+            um único trecho. Defaults to None.
 
     Returns:
         str: A resposta gerada pelo modelo de linguagem, baseada no contexto
              encontrado.
     """
+    # Procura primeiro uma pergunta idêntica no cache, sem precisar de embedding.
+    engine = get_engine()
+    key = hashlib.sha256(question.encode()).hexdigest()
+    cached = await aget_cached_answer(engine, key, None)
+    if cached is not None:
+        return _emit(cached, on_token)
+
+    # Procura uma pergunta semanticamente equivalente no cache.
+    vector = await get_embeddings().aembed_query(question)
+    cached = await aget_cached_answer(engine, key, vector)
+    if cached is not None:
+        return _emit(cached, on_token)
+
     # Realiza a busca de similaridade no PGVector para encontrar os 10
-    # documentos mais relevantes para a pergunta do usuário.
-    results = store.similarity_search_with_score(question, k=10)
+    # documentos mais relevantes para a pergunta do usuário, reaproveitando
+    # o embedding já calculado para a consulta ao cache. Com a reordenação
+    # habilitada, a busca traz mais candidatos, que depois são filtrados.
+    rerank_topk = settings().rerank_topk
+    k = 30 if rerank_topk else 10
+    results = await asimilarity_search(engine, settings().pgvector_collection, vector, k=k)
+
+    # Descarta os trechos cuja distância ultrapassa o limite configurado.
+    score_threshold = settings().score_threshold
+    if score_threshold is not None:
+        results = [(doc, score) for doc, score in results if score <= score_threshold]
+
+    # Reordena os candidatos com o cross-encoder, mantendo apenas os mais
+    # relevantes e reduzindo o tamanho do prompt enviado ao LLM. A inferência
+    # roda em uma thread separada para não bloquear o event loop.
+    if rerank_topk and results:
+        results = await asyncio.to_thread(rerank, question, results, rerank_topk)
+
+    # Ordena os trechos por uma chave estável, e não pela similaridade, removendo
+    # duplicatas: arquivo, página e, entre trechos da mesma página, o próprio
+    # texto. Assim, os mesmos trechos geram sempre o mesmo prompt, o que permite
+    # o reaproveitamento do cache de prefixo de prompts da OpenAI entre
+    # perguntas diferentes.
+    ordered = sorted({
+        (doc.metadata.get("source", ""), doc.metadata.get("page", -1), doc.page_content)
+        for doc, _ in results
+    })
 
     # Concatena o conteúdo dos documentos encontrados para formar um único
     # bloco de texto de contexto, separado por quebras de linha duplas.
-    context = "\n\n".join([doc.page_content for doc, score in results])
+    context = "\n\n".join(page_content for *_, page_content in ordered)
+
+    # Executa a pipeline de RAG (template | llm | parser) com o contexto e a
+    # pergunta, repassando cada trecho da resposta assim que ele é gerado.
+    chunks = []
+    async for chunk in get_pipeline().astream({"context": context, "question": question}):
+        _emit(chunk, on_token)
+        chunks.append(chunk)
+    result = "".join(chunks)
 
-    # Invoca a pipeline de RAG (template | llm | parser) com o contexto
-    # e a pergunta para obter a resposta final.
-    result = pipeline.invoke({"context": context, "question": question})
-    return result
\ No newline at end of file
+    # Grava a pergunta, seu embedding e a resposta no cache.
+    await astore_cached_answer(engine, key, question, vector, result)
+    return result